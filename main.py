@@ -1,20 +1,102 @@
+import asyncio
+import hashlib
+import logging
 import os
 import re
+import time
+from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
+from zoneinfo import ZoneInfo
 import httpx
+import orjson
 import swisseph as swe
+import redis.asyncio as aioredis
+from aiolimiter import AsyncLimiter
 from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
+
+log = logging.getLogger("natal")
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 PUBLIC_URL = os.getenv("PUBLIC_URL", "")
+REDIS_URL = os.getenv("REDIS_URL", "")
+# Файл-отметка: какой URL вебхука мы уже регистрировали (чтобы не дёргать setWebhook на каждом старте).
+# Telegram при этом не опрашивается: если вебхук сняли/поменяли снаружи (deleteWebhook, getUpdates,
+# другой деплой с тем же токеном) — запусти с FORCE_SET_WEBHOOK=1
+WEBHOOK_STAMP_FILE = os.path.abspath(os.getenv(
+    "WEBHOOK_STAMP_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".webhook_stamp")
+))
+FORCE_SET_WEBHOOK = os.getenv("FORCE_SET_WEBHOOK", "") not in ("", "0")
+
+SWE_EPHE_PATH = os.getenv("SWE_EPHE_PATH", "/app/ephe")
 
 TG_API = f"https://api.telegram.org/bot{BOT_TOKEN}"
+GEO_API = "https://nominatim.openstreetmap.org"
+OPENAI_API = "https://api.openai.com"
+
+# Лимиты Telegram: ~30 сообщений/с на бота и ~1/с в один чат
+_tg_global = AsyncLimiter(30, 1)
+# Лимитеры чатов — LRU, чтобы не копить по объекту на каждый когда-либо увиденный чат
+_tg_per_chat: "OrderedDict[int, AsyncLimiter]" = OrderedDict()
+TG_CHAT_LIMITERS_MAX = 10_000
+
+# Telegram ограничивает частоту правок сообщения — не чаще ~1 раза в секунду
+TG_EDIT_INTERVAL = 1.0
+_SENTENCE_END = (".", "!", "?", "…", "\n")
+
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=50, keepalive_expiry=30)
+# К OpenAI много соединений не нужно — узкое место всё равно на стороне модели
+OPENAI_LIMITS = httpx.Limits(max_keepalive_connections=10, max_connections=10, keepalive_expiry=30)
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Путь к эфемеридам задаём один раз — файлы остаются открытыми между запросами
+swe.set_ephe_path(SWE_EPHE_PATH)
 
-app = FastAPI()
+# Планеты (геоцентрические, тропические)
+_PLANET_NAMES = ("Sun", "Moon", "Mercury", "Venus", "Mars",
+                 "Jupiter", "Saturn", "Uranus", "Neptune", "Pluto")
+_PLANET_IDS = (swe.SUN, swe.MOON, swe.MERCURY, swe.VENUS, swe.MARS,
+               swe.JUPITER, swe.SATURN, swe.URANUS, swe.NEPTUNE, swe.PLUTO)
 
-# Простое хранилище состояния (на бесплатных инстансах может сбрасываться при рестарте — для MVP ок)
+# Общие HTTP-клиенты (keep-alive + HTTP/2), создаются на старте приложения
+tg_client: httpx.AsyncClient = None
+geo_client: httpx.AsyncClient = None
+openai_client: httpx.AsyncClient = None
+
+# Состояние диалогов хранится в Redis (общее для всех воркеров, переживает рестарт).
+# Без REDIS_URL — в памяти процесса (сбрасывается при рестарте — для локального запуска ок)
 SESSIONS = {}  # chat_id -> dict(state=..., data=...)
+SESSION_TTL = 86400  # секунд
+
+redis_client: aioredis.Redis = None
+
+# Фоновые задачи держим по ссылке, иначе их может собрать GC до завершения
+_BG_TASKS = set()
+SHUTDOWN_GRACE = 25  # секунд на завершение фоновых задач при остановке
+
+# Блокировки чатов: chat_id -> [Lock, число ожидающих обновлений]
+_CHAT_LOCKS = {}
+
+# Одновременных генераций не больше, чем соединений в пуле OpenAI — иначе лишние ждут пул и падают по PoolTimeout
+_OPENAI_SEM = asyncio.Semaphore(OPENAI_LIMITS.max_connections)
+
+BUSY_TEXT = "Сервер занят, попробуй ещё раз через минуту 🙏"
+
+# Кэш геокодинга: нормализованный запрос -> (lat, lon) или None (не нашли)
+GEO_CACHE: "OrderedDict[str, tuple[float, float] | None]" = OrderedDict()
+GEO_CACHE_MAX = 10_000
+
+# Кэш карт: (jd_ut, lat, lon) -> результат compute_chart
+CHART_CACHE: "OrderedDict[tuple[float, float, float], dict]" = OrderedDict()
+CHART_CACHE_MAX = 10_000
+
+
+_DATE_ISO = re.compile(r"\d{4}-\d{2}-\d{2}")
+_DATE_EU = re.compile(r"\d{2}\.\d{2}\.\d{4}")
+_TIME_HM = re.compile(r"\d{2}:\d{2}")
 
 
 TOPIC_KEYBOARD = {
@@ -41,37 +123,123 @@ def new_session():
             "tz": None,
             "lat": None,
             "lon": None,
-            "topic": None
+            "topic": None,
+            "chart": None
         }
     }
 
 
+def fire(coro):
+    """
+    Запускает корутину в фоне (fire-and-forget), не дожидаясь результата.
+    """
+    task = asyncio.create_task(coro)
+    _BG_TASKS.add(task)
+    task.add_done_callback(_bg_task_done)
+    return task
+
+
+def _bg_task_done(task: asyncio.Task):
+    _BG_TASKS.discard(task)
+    # ошибку фоновой задачи никто не ждёт — логируем сами, чтобы она не потерялась
+    if not task.cancelled() and task.exception() is not None:
+        log.error("Background task failed", exc_info=task.exception())
+
+
+async def get_session(chat_id: int):
+    if redis_client is None:
+        return SESSIONS.get(chat_id)
+    return orjson.loads(await redis_client.get(f"sess:{chat_id}") or b"null")
+
+
+async def save_session(chat_id: int, sess: dict):
+    if redis_client is None:
+        SESSIONS[chat_id] = sess
+        return
+    await redis_client.set(f"sess:{chat_id}", orjson.dumps(sess), ex=SESSION_TTL)
+
+
+def _chat_limiter(chat_id: int) -> AsyncLimiter:
+    limiter = _tg_per_chat.get(chat_id)
+    if limiter is None:
+        limiter = _tg_per_chat[chat_id] = AsyncLimiter(1, 1)
+        if len(_tg_per_chat) > TG_CHAT_LIMITERS_MAX:
+            _tg_per_chat.popitem(last=False)
+    else:
+        _tg_per_chat.move_to_end(chat_id)
+    return limiter
+
+
+def _tg_json(r: httpx.Response) -> dict:
+    # Перед Bot API может стоять прокси, который отдаёт не-JSON (например, HTML-страницу 502)
+    if not r.headers.get("content-type", "").startswith("application/json"):
+        return {"ok": False}
+    try:
+        return orjson.loads(r.content)
+    except orjson.JSONDecodeError:
+        return {"ok": False}
+
+
+async def tg_post_to_chat(chat_id: int, method: str, payload: dict) -> dict:
+    """
+    Запрос к Bot API в рамках чата: с учётом лимитов и одним повтором после 429.
+    """
+    content = orjson.dumps(payload)
+    for attempt in range(2):
+        # сначала лимит чата: ожидание в нём не должно занимать глобальный слот
+        async with _chat_limiter(chat_id), _tg_global:
+            r = await tg_client.post(method, content=content)
+        data = _tg_json(r)
+        if r.status_code != 429 or attempt:
+            return data
+        await asyncio.sleep(data.get("parameters", {}).get("retry_after", 1))
+
+
 async def tg_send_message(chat_id: int, text: str, reply_markup=None):
     payload = {"chat_id": chat_id, "text": text, "disable_web_page_preview": True}
     if reply_markup:
         payload["reply_markup"] = reply_markup
-    async with httpx.AsyncClient(timeout=30) as client:
-        await client.post(f"{TG_API}/sendMessage", json=payload)
+    data = await tg_post_to_chat(chat_id, "/sendMessage", payload)
+    return data.get("result", {}).get("message_id")
+
+
+async def tg_edit_message(chat_id: int, message_id: int, text: str):
+    payload = {"chat_id": chat_id, "message_id": message_id, "text": text, "disable_web_page_preview": True}
+    await tg_post_to_chat(chat_id, "/editMessageText", payload)
 
 
 async def tg_answer_callback(callback_query_id: str):
-    async with httpx.AsyncClient(timeout=30) as client:
-        await client.post(f"{TG_API}/answerCallbackQuery", json={"callback_query_id": callback_query_id})
+    await tg_client.post("/answerCallbackQuery", content=orjson.dumps({"callback_query_id": callback_query_id}))
 
 
 async def set_webhook():
     if not PUBLIC_URL:
         return
-    async with httpx.AsyncClient(timeout=30) as client:
-        await client.post(f"{TG_API}/setWebhook", json={"url": f"{PUBLIC_URL}/webhook"})
+    url = f"{PUBLIC_URL}/webhook"
+    stamp = hashlib.sha256(f"{BOT_TOKEN}:{url}".encode()).hexdigest()
+    if not FORCE_SET_WEBHOOK:
+        try:
+            with open(WEBHOOK_STAMP_FILE) as f:
+                if f.read().strip() == stamp:
+                    return
+        except OSError:
+            pass
+
+    r = await tg_client.post("/setWebhook", content=orjson.dumps({"url": url}))
+    if _tg_json(r).get("ok"):
+        try:
+            with open(WEBHOOK_STAMP_FILE, "w") as f:
+                f.write(stamp)
+        except OSError:
+            pass
 
 
 def parse_date(s: str):
     # YYYY-MM-DD или DD.MM.YYYY
     s = s.strip()
-    if re.fullmatch(r"\d{4}-\d{2}-\d{2}", s):
+    if _DATE_ISO.fullmatch(s):
         return datetime.strptime(s, "%Y-%m-%d").date()
-    if re.fullmatch(r"\d{2}\.\d{2}\.\d{4}", s):
+    if _DATE_EU.fullmatch(s):
         return datetime.strptime(s, "%d.%m.%Y").date()
     return None
 
@@ -79,7 +247,7 @@ def parse_date(s: str):
 def parse_time(s: str):
     # HH:MM (24h)
     s = s.strip()
-    if re.fullmatch(r"\d{2}:\d{2}", s):
+    if _TIME_HM.fullmatch(s):
         h, m = map(int, s.split(":"))
         if 0 <= h <= 23 and 0 <= m <= 59:
             return (h, m)
@@ -87,30 +255,44 @@ def parse_time(s: str):
 
 
 async def geocode_city(city: str, country: str):
-    url = "https://nominatim.openstreetmap.org/search"
-    headers = {"User-Agent": "natal-bot/1.0 (contact: example@example.com)"}
-
     async def _try(q: str):
+        key = q.lower().strip()
+        if key in GEO_CACHE:
+            GEO_CACHE.move_to_end(key)
+            return GEO_CACHE[key]
+
         params = {"q": q, "format": "json", "limit": 1}
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.get(url, params=params, headers=headers)
-            r.raise_for_status()
-            data = r.json()
-        if not data:
-            return None
-        return float(data[0]["lat"]), float(data[0]["lon"])
-
-    # 1) city, country
-    res = await _try(f"{city}, {country}")
-    if res:
-        return res
+        r = await geo_client.get("/search", params=params)
+        r.raise_for_status()
+        data = orjson.loads(r.content)
+        res = (float(data[0]["lat"]), float(data[0]["lon"])) if data else None
 
-    # 2) city only
-    res = await _try(city)
-    if res:
+        GEO_CACHE[key] = res
+        if len(GEO_CACHE) > GEO_CACHE_MAX:
+            GEO_CACHE.popitem(last=False)
         return res
 
-    
+    full_q = f"{city}, {country}"
+    if GEO_CACHE.get(full_q.lower().strip()):
+        return await _try(full_q)
+
+    # Оба варианта параллельно; приоритет у более точного "city, country"
+    results = await asyncio.gather(_try(full_q), _try(city), return_exceptions=True)
+    for res in results:
+        if res and not isinstance(res, BaseException):
+            return res
+    for res in results:
+        if isinstance(res, BaseException):
+            raise res
+    return None
+
+
+_UTC = ZoneInfo("UTC")
+
+
+@lru_cache(maxsize=512)
+def _tz(name: str) -> ZoneInfo:
+    return ZoneInfo(name)
 
 
 def compute_chart(lat: float, lon: float, dt_local: datetime, tz_str: str):
@@ -119,84 +301,151 @@ def compute_chart(lat: float, lon: float, dt_local: datetime, tz_str: str):
     Важно: для MVP просим пользователя ввести TZ правильно.
     """
     # Конвертируем локальное время в UTC через стандартную библиотеку zoneinfo (Python 3.9+)
-    from zoneinfo import ZoneInfo
-    dt_utc = dt_local.replace(tzinfo=ZoneInfo(tz_str)).astimezone(ZoneInfo("UTC"))
+    dt_utc = dt_local.replace(tzinfo=_tz(tz_str)).astimezone(_UTC)
 
     # Julian day (UT)
     jd_ut = swe.julday(dt_utc.year, dt_utc.month, dt_utc.day,
                        dt_utc.hour + dt_utc.minute/60.0 + dt_utc.second/3600.0)
 
-    # Планеты (геоцентрические, тропические)
-    planets = {
-        "Sun": swe.SUN,
-        "Moon": swe.MOON,
-        "Mercury": swe.MERCURY,
-        "Venus": swe.VENUS,
-        "Mars": swe.MARS,
-        "Jupiter": swe.JUPITER,
-        "Saturn": swe.SATURN,
-        "Uranus": swe.URANUS,
-        "Neptune": swe.NEPTUNE,
-        "Pluto": swe.PLUTO
-    }
+    key = (round(jd_ut, 6), round(lat, 4), round(lon, 4))
+    if key in CHART_CACHE:
+        CHART_CACHE.move_to_end(key)
+        return CHART_CACHE[key]
 
-    positions = {}
-    for name, pid in planets.items():
-        lonlat, _ = swe.calc_ut(jd_ut, pid)  # lonlat[0] = ecliptic longitude
-        positions[name] = lonlat[0]
+    # calc_ut(...)[0][0] = ecliptic longitude
+    positions = {name: swe.calc_ut(jd_ut, pid)[0][0] for name, pid in zip(_PLANET_NAMES, _PLANET_IDS)}
 
     # Дома/Asc
     # Placidus ("P") — норм для “обычной” западной астрологии
     houses, ascmc = swe.houses(jd_ut, lat, lon, b'P')
     asc = ascmc[0]  # Ascendant longitude
 
-    return {
+    chart = {
         "utc": dt_utc.isoformat(),
         "positions": positions,
         "asc": asc
     }
+    CHART_CACHE[key] = chart
+    if len(CHART_CACHE) > CHART_CACHE_MAX:
+        CHART_CACHE.popitem(last=False)
+    return chart
+
+
+# Трёхбуквенные коды знаков — компактнее для промпта
+_SIGNS = ("Ari", "Tau", "Gem", "Can", "Leo", "Vir",
+          "Lib", "Sco", "Sag", "Cap", "Aqu", "Pis")
 
 
 def deg_to_sign(deg: float):
-    signs = ["Aries","Taurus","Gemini","Cancer","Leo","Virgo","Libra","Scorpio","Sagittarius","Capricorn","Aquarius","Pisces"]
-    idx = int(deg // 30) % 12
-    within = deg % 30
-    return signs[idx], within
+    deg = deg % 360.0
+    idx = min(int(deg * (1 / 30)), 11)  # min() — защита от округления у самых 360°
+    within = deg - idx * 30
+    return _SIGNS[idx], within
 
 
 def chart_to_text(chart: dict):
-    lines = []
+    # Одной строкой, экономим токены: "ASC=Ari12.3 Sun=Leo4.0 ..."
+    parts = []
     # Asc
     s, within = deg_to_sign(chart["asc"])
-    lines.append(f"Ascendant: {s} {within:.1f}°")
+    parts.append(f"ASC={s}{within:.1f}")
 
-    for k in ["Sun","Moon","Mercury","Venus","Mars","Jupiter","Saturn","Uranus","Neptune","Pluto"]:
+    for k in _PLANET_NAMES:
         s, within = deg_to_sign(chart["positions"][k])
-        lines.append(f"{k}: {s} {within:.1f}°")
-    return "\n".join(lines)
+        parts.append(f"{k}={s}{within:.1f}")
+    return " ".join(parts)
 
 
-async def call_openai(system_prompt: str, user_text: str) -> str:
-    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
+async def call_openai(system_prompt: str, user_text: str):
+    """
+    Стримит ответ модели (SSE) и отдаёт текст кусками по мере генерации.
+    """
     payload = {
         "model": "gpt-4.1-mini",
         "input": [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_text}
         ],
-        "max_output_tokens": 450
+        "max_output_tokens": 450,
+        "stream": True
     }
-    async with httpx.AsyncClient(timeout=45) as client:
-        r = await client.post("https://api.openai.com/v1/responses", headers=headers, json=payload)
+    async with openai_client.stream("POST", "/v1/responses", content=orjson.dumps(payload)) as r:
         r.raise_for_status()
-        data = r.json()
+        async for line in r.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if not data or data == "[DONE]":
+                continue
+            event = orjson.loads(data)
+            kind = event.get("type")
+            if kind == "response.output_text.delta":
+                yield event.get("delta", "")
+            elif kind in ("response.failed", "error"):
+                raise RuntimeError(f"OpenAI stream failed: {data}")
+
+
+async def _put_answer(chat_id: int, message_id, text: str):
+    # Если заглушку отправить не удалось — шлём отдельным сообщением
+    if message_id is None:
+        await tg_send_message(chat_id, text)
+    else:
+        await tg_edit_message(chat_id, message_id, text)
+
+
+async def send_openai_answer(chat_id: int, system_prompt: str, user_text: str) -> bool:
+    """
+    Отправляет ответ модели, дописывая его по мере генерации.
+    Возвращает False, если ответ получить не удалось (заглушка заменяется сообщением об ошибке).
+    """
+    # Сразу показываем заглушку, потом дописываем её по мере генерации
+    message_id = await tg_send_message(chat_id, "…")
+
+    answer = ""
+    sent = ""
+    last_edit = time.monotonic()
+    try:
+        async for delta in call_openai(system_prompt, user_text):
+            answer += delta
+            # правим сообщение на границе предложения, но не чаще TG_EDIT_INTERVAL
+            # (если с прошлой правки пришли только пробелы/переводы строк — править нечего)
+            if (message_id is not None and answer.rstrip(" ").endswith(_SENTENCE_END)
+                    and time.monotonic() - last_edit >= TG_EDIT_INTERVAL and answer.strip() != sent):
+                sent = answer.strip()
+                await tg_edit_message(chat_id, message_id, sent)
+                last_edit = time.monotonic()
+    except httpx.PoolTimeout as e:
+        if e.request.url.host != openai_client.base_url.host:
+            raise  # исчерпан пул Telegram — отвечать через него же бессмысленно, разберётся _process_update
+        log.warning("OpenAI connection pool exhausted, chat %s", chat_id)
+        await _put_answer(chat_id, message_id, BUSY_TEXT)
+        return False
+    except Exception:
+        log.exception("OpenAI request failed for chat %s", chat_id)
+        await _put_answer(chat_id, message_id, "Не получилось получить ответ 😕 Попробуй задать вопрос ещё раз.")
+        return False
+
+    answer = answer.strip() or "Не получилось сформировать ответ — попробуй написать иначе 🙂"
+    if answer != sent:
+        await _put_answer(chat_id, message_id, answer)
+    return True
+
+
+SYSTEM_PROMPT_TMPL = """
+Ты — тёплый и понятный астрологический помощник. Без мистики-страшилок, без фатализма.
+Отвечай на русском.
+Формат ответа:
+- 1 абзац: суть по запросу
+- 3–6 буллетов: что это значит + сильные стороны/риски
+- 2 практичных шага (что сделать сегодня/на неделе)
+
+Данные натальной карты (тропическая):
+{chart_text}
 
-    out = []
-    for item in data.get("output", []):
-        for c in item.get("content", []):
-            if c.get("type") == "output_text":
-                out.append(c.get("text", ""))
-    return "\n".join(out).strip() or "Не получилось сформировать ответ — попробуй написать иначе 🙂"
+Контекст:
+- Тема: {topic}
+- Вопрос пользователя: {text}
+"""
 
 
 def topic_label(topic: str) -> str:
@@ -211,153 +460,140 @@ def topic_label(topic: str) -> str:
 
 @app.on_event("startup")
 async def on_startup():
+    global tg_client, geo_client, openai_client, redis_client
+    if REDIS_URL:
+        redis_client = aioredis.Redis.from_url(REDIS_URL)
+    tg_client = httpx.AsyncClient(
+        base_url=TG_API, http2=True, limits=HTTP_LIMITS, timeout=30,
+        headers={"Content-Type": "application/json"}
+    )
+    geo_client = httpx.AsyncClient(
+        base_url=GEO_API, http2=True, limits=HTTP_LIMITS, timeout=30,
+        headers={"User-Agent": "natal-bot/1.0 (contact: example@example.com)"}
+    )
+    openai_client = httpx.AsyncClient(
+        base_url=OPENAI_API, http2=True, limits=OPENAI_LIMITS, timeout=45,
+        headers={"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
+    )
     await set_webhook()
 
 
-@app.get("/")
-async def health():
-    return {"ok": True}
-
+@app.on_event("shutdown")
+async def on_shutdown():
+    # Даём фоновым задачам (уже подтверждённым обновлениям) закончиться, пока клиенты открыты
+    deadline = time.monotonic() + SHUTDOWN_GRACE
+    while _BG_TASKS and time.monotonic() < deadline:
+        await asyncio.wait(set(_BG_TASKS), timeout=deadline - time.monotonic())
+    pending = set(_BG_TASKS)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
 
-@app.post("/webhook")
-async def webhook(req: Request):
-    update = await req.json()
+    for client in (tg_client, geo_client, openai_client):
+        if client is not None:
+            await client.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
 
-    # Callback (кнопки)
-    if "callback_query" in update:
-        cq = update["callback_query"]
-        chat_id = cq["message"]["chat"]["id"]
-        data = cq.get("data", "")
-        await tg_answer_callback(cq["id"])
 
-        sess = SESSIONS.get(chat_id) or new_session()
-        SESSIONS[chat_id] = sess
+@app.get("/")
+async def health():
+    return {"ok": True}
 
-        if data.startswith("topic:"):
-            sess["data"]["topic"] = data.split(":", 1)[1]
-            sess["state"] = "ASK_FREEFORM"
-            await tg_send_message(chat_id,
-                "Ок 🙂 Напиши одним сообщением, что именно хочешь разобрать по этой теме.\n"
-                "Например: «почему у меня повторяются такие отношения?» или «куда расти в карьере?»"
-            )
-        return {"ok": True}
 
-    msg = update.get("message") or update.get("edited_message")
-    if not msg:
-        return {"ok": True}
+async def handle_ask_date(sess: dict, d: dict, text: str, chat_id: int):
+    dt = parse_date(text)
+    if not dt:
+        await tg_send_message(chat_id, "Не поняла дату. Пример: 1992-08-14 или 14.08.1992")
+        return
+    d["date"] = dt.isoformat()
+    sess["state"] = "ASK_TIME"
+    await save_session(chat_id, sess)
+    await tg_send_message(chat_id, "Отлично. Введи время рождения (HH:MM), например 07:30")
 
-    chat_id = msg["chat"]["id"]
-    text = (msg.get("text") or "").strip()
 
-    if not text:
-        await tg_send_message(chat_id, "Напиши текстом 🙂")
-        return {"ok": True}
+async def handle_ask_time(sess: dict, d: dict, text: str, chat_id: int):
+    tm = parse_time(text)
+    if not tm:
+        await tg_send_message(chat_id, "Не поняла время. Пример: 07:30 (24-часовой формат)")
+        return
+    d["time"] = f"{tm[0]:02d}:{tm[1]:02d}"
+    sess["state"] = "ASK_CITY"
+    await save_session(chat_id, sess)
+    await tg_send_message(chat_id, "Город рождения? (например: Barcelona)")
 
-    # Команды
-    if text.lower() in ("/start", "start"):
-        SESSIONS[chat_id] = new_session()
-        await tg_send_message(chat_id,
-            "Привет 🙂 Я помогу сделать натальную карту.\n\n"
-            "Сначала введём данные.\n"
-            "Введи дату рождения (YYYY-MM-DD или DD.MM.YYYY)."
-        )
-        return {"ok": True}
 
-    if text.lower() in ("/reset", "reset"):
-        SESSIONS[chat_id] = new_session()
-        await tg_send_message(chat_id,
-            "Сбросила ввод ✅\nВведи дату рождения (YYYY-MM-DD или DD.MM.YYYY)."
-        )
-        return {"ok": True}
+async def handle_ask_city(sess: dict, d: dict, text: str, chat_id: int):
+    # принимаем "City", либо "City, Country", либо "City / Country"
+    normalized = text.replace("/", ",")
+    parts = [p.strip() for p in normalized.split(",") if p.strip()]
 
-    sess = SESSIONS.get(chat_id)
-    if not sess:
-        sess = new_session()
-        SESSIONS[chat_id] = sess
-        await tg_send_message(chat_id,
-            "Давай начнём 🙂 Введи дату рождения (YYYY-MM-DD или DD.MM.YYYY)."
-        )
-        return {"ok": True}
-
-    state = sess["state"]
-    d = sess["data"]
-
-    # Шаги ввода
-    if state == "ASK_DATE":
-        dt = parse_date(text)
-        if not dt:
-            await tg_send_message(chat_id, "Не поняла дату. Пример: 1992-08-14 или 14.08.1992")
-            return {"ok": True}
-        d["date"] = dt.isoformat()
-        sess["state"] = "ASK_TIME"
-        await tg_send_message(chat_id, "Отлично. Введи время рождения (HH:MM), например 07:30")
-        return {"ok": True}
-
-    if state == "ASK_TIME":
-        tm = parse_time(text)
-        if not tm:
-            await tg_send_message(chat_id, "Не поняла время. Пример: 07:30 (24-часовой формат)")
-            return {"ok": True}
-        d["time"] = f"{tm[0]:02d}:{tm[1]:02d}"
-        sess["state"] = "ASK_CITY"
-        await tg_send_message(chat_id, "Город рождения? (например: Barcelona)")
-        return {"ok": True}
-
-       if state == "ASK_CITY":
-        # принимаем "City", либо "City, Country", либо "City / Country"
-        normalized = text.replace("/", ",")
-        parts = [p.strip() for p in normalized.split(",") if p.strip()]
-
-        if len(parts) >= 2:
-            d["city"] = parts[0]
-            d["country"] = parts[1]
-            sess["state"] = "ASK_TZ"
-            await tg_send_message(chat_id,
-                "Ок. Теперь часовой пояс в формате IANA.\n"
-                "Пример: Europe/Amsterdam или Europe/Madrid"
-            )
-        else:
-            d["city"] = text.strip()
-            sess["state"] = "ASK_COUNTRY"
-            await tg_send_message(chat_id, "Страна рождения? (например: Russia)")
-        return {"ok": True}
-
-    if state == "ASK_COUNTRY":
-        d["country"] = text.strip()
+    if len(parts) >= 2:
+        d["city"] = parts[0]
+        d["country"] = parts[1]
         sess["state"] = "ASK_TZ"
+        await save_session(chat_id, sess)
         await tg_send_message(chat_id,
-            "Часовой пояс в формате IANA.\n"
+            "Ок. Теперь часовой пояс в формате IANA.\n"
             "Пример: Europe/Amsterdam или Europe/Madrid"
         )
-        return {"ok": True}
+    else:
+        d["city"] = text.strip()
+        sess["state"] = "ASK_COUNTRY"
+        await save_session(chat_id, sess)
+        await tg_send_message(chat_id, "Страна рождения? (например: Russia)")
+
+
+async def handle_ask_country(sess: dict, d: dict, text: str, chat_id: int):
+    d["country"] = text.strip()
+    sess["state"] = "ASK_TZ"
+    await save_session(chat_id, sess)
+    await tg_send_message(chat_id,
+        "Часовой пояс в формате IANA.\n"
+        "Пример: Europe/Amsterdam или Europe/Madrid"
+    )
+
+
+async def handle_ask_tz(sess: dict, d: dict, text: str, chat_id: int):
+    if "/" not in text or " " in text:
+        await tg_send_message(chat_id, "Похоже на неверный формат. Пример: Europe/Amsterdam")
+        return
+    d["tz"] = text.strip()
+    sess["state"] = "ASK_TOPIC"
+    await save_session(chat_id, sess)
+    await tg_send_message(chat_id, "Теперь выбери тему 👇", reply_markup=TOPIC_KEYBOARD)
 
-    if state == "ASK_TZ":
-        if "/" not in text or " " in text:
-            await tg_send_message(chat_id, "Похоже на неверный формат. Пример: Europe/Amsterdam")
-            return {"ok": True}
-        d["tz"] = text.strip()
-        sess["state"] = "ASK_TOPIC"
-        await tg_send_message(chat_id, "Теперь выбери тему 👇", reply_markup=TOPIC_KEYBOARD)
-        return {"ok": True}
 
+async def handle_ask_freeform(sess: dict, d: dict, text: str, chat_id: int):
+    if not OPENAI_API_KEY:
+        await tg_send_message(chat_id, "Бот запущен, но не настроен OPENAI_API_KEY.")
+        return
 
-    if state == "ASK_FREEFORM":
-        if not OPENAI_API_KEY:
-            await tg_send_message(chat_id, "Бот запущен, но не настроен OPENAI_API_KEY.")
-            return {"ok": True}
+    # Карта уже посчитана в этой сессии — данные рождения не менялись
+    chart = d.get("chart")
+    notice = None
+    if chart is None:
+        # Сообщение уходит параллельно с геокодингом и расчётом
+        notice = fire(tg_send_message(chat_id, "⏳ считаю карту…"))
 
         # Геокодинг
         try:
             coords = await geocode_city(d["city"], d["country"])
+        except httpx.PoolTimeout:
+            # Nominatim перегружен — город тут ни при чём, пусть спросит ещё раз позже
+            await notice
+            raise
         except Exception:
             coords = None
         if not coords:
+            await notice
             await tg_send_message(chat_id,
                 "Не смогла найти координаты города 😕\n"
                 "Попробуй написать город/страну на английском или крупнее (например: Moscow, Russia)."
             )
             sess["state"] = "ASK_CITY"
-            return {"ok": True}
+            await save_session(chat_id, sess)
+            return
 
         d["lat"], d["lon"] = coords[0], coords[1]
 
@@ -368,37 +604,178 @@ async def webhook(req: Request):
 
         try:
             chart = compute_chart(d["lat"], d["lon"], dt_local, d["tz"])
-            chart_text = chart_to_text(chart)
         except Exception as e:
+            await notice
             await tg_send_message(chat_id, f"Ошибка расчёта карты 😕 ({e})\nПопробуй /reset и введи данные заново.")
-            return {"ok": True}
+            return
+        d["chart"] = chart
+        # сохраняем карту сразу: если генерация ниже упадёт, повтор не будет считать её заново
+        await save_session(chat_id, sess)
+
+    chart_text = chart_to_text(chart)
+
+    topic = topic_label(d["topic"])
+
+    system_prompt = SYSTEM_PROMPT_TMPL.format_map({"chart_text": chart_text, "topic": topic, "text": text})
+
+    if notice is not None:
+        await notice  # чтобы ответ пришёл после «считаю карту»
+    async with _OPENAI_SEM:
+        ok = await send_openai_answer(chat_id, system_prompt, text)
+    if not ok:
+        return  # остаёмся в ASK_FREEFORM — можно спросить ещё раз
+
+    # после ответа — предложим следующий вопрос по той же карте
+    sess["state"] = "ASK_TOPIC"
+    await save_session(chat_id, sess)
+    await tg_send_message(chat_id, "Хочешь ещё один разбор? Выбери тему 👇", reply_markup=TOPIC_KEYBOARD)
+
+
+# Шаги ввода: состояние диалога -> обработчик
+_HANDLERS = {
+    "ASK_DATE": handle_ask_date,
+    "ASK_TIME": handle_ask_time,
+    "ASK_CITY": handle_ask_city,
+    "ASK_COUNTRY": handle_ask_country,
+    "ASK_TZ": handle_ask_tz,
+    "ASK_FREEFORM": handle_ask_freeform,
+}
 
-        topic = topic_label(d["topic"])
 
-        system_prompt = f"""
-Ты — тёплый и понятный астрологический помощник. Без мистики-страшилок, без фатализма.
-Отвечай на русском.
-Формат ответа:
-- 1 абзац: суть по запросу
-- 3–6 буллетов: что это значит + сильные стороны/риски
-- 2 практичных шага (что сделать сегодня/на неделе)
+@app.post("/webhook")
+async def webhook(req: Request):
+    # Отвечаем Telegram сразу, само обновление обрабатываем в фоне
+    update = orjson.loads(await req.body())
+    fire(_process_update(update))
+    return {"ok": True}
 
-Данные натальной карты (тропическая):
-{chart_text}
 
-Контекст:
-- Тема: {topic}
-- Вопрос пользователя: {text}
-"""
+def _update_chat_id(update: dict):
+    if "callback_query" in update:
+        return update["callback_query"]["message"]["chat"]["id"]
+    msg = update.get("message") or update.get("edited_message")
+    return msg["chat"]["id"] if msg else None
+
 
-        answer = await call_openai(system_prompt, text)
-        await tg_send_message(chat_id, answer)
+async def _process_update(update: dict):
+    chat_id = _update_chat_id(update)
+    if chat_id is None:
+        return
+
+    # На нажатие кнопки отвечаем сразу, не дожидаясь очереди чата — иначе кнопка «крутится»,
+    # пока идёт генерация, и Telegram может счесть запрос устаревшим
+    if "callback_query" in update:
+        try:
+            await tg_answer_callback(update["callback_query"]["id"])
+        except Exception:
+            log.exception("Failed to answer callback query in chat %s", chat_id)
+
+    # Обновления одного чата обрабатываем по очереди: иначе параллельные
+    # get_session -> save_session теряют изменения, а второе сообщение во время
+    # генерации запускает ещё один запрос к OpenAI
+    entry = _CHAT_LOCKS.get(chat_id)
+    if entry is None:
+        entry = _CHAT_LOCKS[chat_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            await _handle_update(update, chat_id)
+    except httpx.PoolTimeout as e:
+        # все соединения заняты — просим повторить, но не через тот же исчерпанный пул Telegram
+        log.warning("Connection pool exhausted: %s", e.request.url.host)
+        if e.request.url.host != tg_client.base_url.host:
+            try:
+                await tg_send_message(chat_id, BUSY_TEXT)
+            except Exception:
+                log.exception("Failed to notify chat %s about the error", chat_id)
+    except Exception:
+        # Telegram уже получил 200 и обновление не пришлёт повторно — логируем и говорим пользователю
+        log.exception("Failed to process update %s", update.get("update_id"))
+        try:
+            await tg_send_message(chat_id, "Что-то пошло не так 😕 Попробуй ещё раз чуть позже.")
+        except Exception:
+            log.exception("Failed to notify chat %s about the error", chat_id)
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _CHAT_LOCKS[chat_id]
 
-        # после ответа — предложим следующий вопрос по той же карте
-        sess["state"] = "ASK_TOPIC"
-        await tg_send_message(chat_id, "Хочешь ещё один разбор? Выбери тему 👇", reply_markup=TOPIC_KEYBOARD)
-        return {"ok": True}
+
+async def _handle_update(update: dict, chat_id: int):
+    # Callback (кнопки)
+    if "callback_query" in update:
+        cq = update["callback_query"]
+        data = cq.get("data", "")
+
+        sess = await get_session(chat_id)
+
+        if data.startswith("topic:"):
+            # Сессия истекла (TTL) или данные рождения не введены — начинаем ввод заново
+            d = sess["data"] if sess else {}
+            if not (d.get("date") and d.get("time") and d.get("tz")):
+                await save_session(chat_id, new_session())
+                await tg_send_message(chat_id,
+                    "Давай начнём 🙂 Введи дату рождения (YYYY-MM-DD или DD.MM.YYYY)."
+                )
+                return
+
+            sess["data"]["topic"] = data.split(":", 1)[1]
+            sess["state"] = "ASK_FREEFORM"
+            await save_session(chat_id, sess)
+            await tg_send_message(chat_id,
+                "Ок 🙂 Напиши одним сообщением, что именно хочешь разобрать по этой теме.\n"
+                "Например: «почему у меня повторяются такие отношения?» или «куда расти в карьере?»"
+            )
+        return
+
+    msg = update.get("message") or update.get("edited_message")
+    text = (msg.get("text") or "").strip()
+
+    if not text:
+        await tg_send_message(chat_id, "Напиши текстом 🙂")
+        return
+
+    # Команды
+    if text.lower() in ("/start", "start"):
+        await save_session(chat_id, new_session())
+        await tg_send_message(chat_id,
+            "Привет 🙂 Я помогу сделать натальную карту.\n\n"
+            "Сначала введём данные.\n"
+            "Введи дату рождения (YYYY-MM-DD или DD.MM.YYYY)."
+        )
+        return
+
+    if text.lower() in ("/reset", "reset"):
+        await save_session(chat_id, new_session())
+        await tg_send_message(chat_id,
+            "Сбросила ввод ✅\nВведи дату рождения (YYYY-MM-DD или DD.MM.YYYY)."
+        )
+        return
+
+    sess = await get_session(chat_id)
+    if not sess:
+        await save_session(chat_id, new_session())
+        await tg_send_message(chat_id,
+            "Давай начнём 🙂 Введи дату рождения (YYYY-MM-DD или DD.MM.YYYY)."
+        )
+        return
+
+    handler = _HANDLERS.get(sess["state"])
+    if handler:
+        await handler(sess, sess["data"], text, chat_id)
+        return
 
     # fallback
     await tg_send_message(chat_id, "Я чуть потерялась 😅 Напиши /start чтобы начать заново.")
-    return {"ok": True}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # По умолчанию один воркер. Лимиты _tg_global/_tg_per_chat, _OPENAI_SEM и блокировки чатов
+    # живут в памяти процесса: при N воркерах реальные лимиты становятся N×30 сообщений/с и
+    # N×OPENAI_LIMITS.max_connections генераций, а set_webhook выполняется в каждом воркере.
+    # Несколько воркеров (WEB_CONCURRENCY) — только с REDIS_URL и с учётом этого.
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    uvicorn.run("main:app", host="0.0.0.0", port=int(os.getenv("PORT", "8000")),
+                loop="uvloop", http="httptools", workers=workers)
@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Подменяет отправку в Telegram и собирает тексты отправленных сообщений."""
+    messages = []
+
+    async def fake_send(chat_id, text, reply_markup=None):
+        messages.append(text)
+        return len(messages)
+
+    async def fake_answer_callback(callback_query_id):
+        pass
+
+    monkeypatch.setattr(main, "tg_send_message", fake_send)
+    monkeypatch.setattr(main, "tg_answer_callback", fake_answer_callback)
+    monkeypatch.setattr(main, "SESSIONS", {})
+    return messages
+
+
+@pytest.fixture
+def bot(sent):
+    """Отправляет обновление в /webhook и ждёт окончания фоновой обработки."""
+    with TestClient(main.app) as client:
+        def post(update):
+            assert client.post("/webhook", json=update).status_code == 200
+            deadline = time.monotonic() + 5
+            while main._BG_TASKS and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert not main._BG_TASKS
+
+        yield post
+
+
+def message(text, chat_id=1):
+    return {"update_id": 1, "message": {"chat": {"id": chat_id}, "text": text}}
@@ -0,0 +1,40 @@
+from collections import OrderedDict
+from datetime import datetime
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("deg, sign, within", [
+    (0.0, "Ari", 0.0),
+    (29.9, "Ari", 29.9),
+    (30.0, "Tau", 0.0),
+    (135.5, "Leo", 15.5),
+    (359.99, "Pis", 29.99),
+    (360.0, "Ari", 0.0),
+    (-15.0, "Pis", 15.0),
+    (725.0, "Ari", 5.0),
+])
+def test_deg_to_sign(deg, sign, within):
+    s, w = main.deg_to_sign(deg)
+    assert s == sign
+    assert w == pytest.approx(within)
+
+
+def test_deg_to_sign_every_boundary():
+    for idx in range(12):
+        assert main.deg_to_sign(idx * 30.0) == (main._SIGNS[idx], 0.0)
+
+
+def test_compute_chart_uses_cache(monkeypatch):
+    monkeypatch.setattr(main, "CHART_CACHE", OrderedDict())
+    dt_local = datetime(1992, 8, 14, 7, 30)
+    first = main.compute_chart(41.39, 2.17, dt_local, "Europe/Madrid")
+
+    def no_calc(*args):
+        raise AssertionError("swisseph should not be called on a cache hit")
+
+    monkeypatch.setattr(main.swe, "calc_ut", no_calc)
+    monkeypatch.setattr(main.swe, "houses", no_calc)
+    assert main.compute_chart(41.39, 2.17, dt_local, "Europe/Madrid") is first
@@ -0,0 +1,67 @@
+import asyncio
+from collections import OrderedDict
+
+import httpx
+import pytest
+
+import main
+
+
+def use_nominatim(monkeypatch, answers):
+    """answers: запрос -> список результатов Nominatim или HTTP-статус ошибки."""
+    requests = []
+
+    def handler(request):
+        q = request.url.params["q"]
+        requests.append(q)
+        answer = answers[q]
+        if isinstance(answer, int):
+            return httpx.Response(answer)
+        return httpx.Response(200, json=answer)
+
+    client = httpx.AsyncClient(base_url=main.GEO_API, transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(main, "geo_client", client)
+    monkeypatch.setattr(main, "GEO_CACHE", OrderedDict())
+    return requests
+
+
+def place(lat, lon):
+    return [{"lat": str(lat), "lon": str(lon)}]
+
+
+def geocode(city, country):
+    return asyncio.run(main.geocode_city(city, country))
+
+
+def test_prefers_city_with_country(monkeypatch):
+    use_nominatim(monkeypatch, {"Paris, USA": place(33.6, -95.5), "Paris": place(48.8, 2.3)})
+    assert geocode("Paris", "USA") == (33.6, -95.5)
+
+
+def test_falls_back_to_city_only(monkeypatch):
+    use_nominatim(monkeypatch, {"Paris, Nowhere": [], "Paris": place(48.8, 2.3)})
+    assert geocode("Paris", "Nowhere") == (48.8, 2.3)
+
+
+def test_error_on_one_query_uses_the_other(monkeypatch):
+    use_nominatim(monkeypatch, {"Paris, France": 500, "Paris": place(48.8, 2.3)})
+    assert geocode("Paris", "France") == (48.8, 2.3)
+
+
+def test_nothing_found(monkeypatch):
+    use_nominatim(monkeypatch, {"Xyz, Abc": [], "Xyz": []})
+    assert geocode("Xyz", "Abc") is None
+
+
+def test_both_errors_raise(monkeypatch):
+    use_nominatim(monkeypatch, {"Paris, France": 503, "Paris": 503})
+    with pytest.raises(httpx.HTTPStatusError):
+        geocode("Paris", "France")
+
+
+def test_cached_full_query_skips_fallback(monkeypatch):
+    requests = use_nominatim(monkeypatch, {"Paris, France": place(48.8, 2.3), "Paris": place(48.8, 2.3)})
+    geocode("Paris", "France")
+    requests.clear()
+    assert geocode("Paris", "France") == (48.8, 2.3)
+    assert requests == []
@@ -0,0 +1,104 @@
+import asyncio
+
+import httpx
+import orjson
+import pytest
+
+import main
+
+
+def sse(*events):
+    return b"".join(b"data: " + orjson.dumps(e) + b"\n\n" for e in events) + b"data: [DONE]\n\n"
+
+
+def delta(text):
+    return {"type": "response.output_text.delta", "delta": text}
+
+
+def use_openai(monkeypatch, status=200, body=b""):
+    def handler(request):
+        return httpx.Response(status, content=body, headers={"content-type": "text/event-stream"})
+
+    client = httpx.AsyncClient(base_url=main.OPENAI_API, transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(main, "openai_client", client)
+
+
+class Calls(list):
+    message_id = 1  # что вернёт sendMessage
+
+
+@pytest.fixture
+def telegram(monkeypatch):
+    """Записывает sendMessage/editMessageText как ("send"|"edit", message_id, text)."""
+    calls = Calls()
+
+    async def fake_send(chat_id, text, reply_markup=None):
+        calls.append(("send", None, text))
+        return calls.message_id
+
+    async def fake_edit(chat_id, mid, text):
+        calls.append(("edit", mid, text))
+
+    monkeypatch.setattr(main, "tg_send_message", fake_send)
+    monkeypatch.setattr(main, "tg_edit_message", fake_edit)
+    return calls
+
+
+async def collect(gen):
+    return [x async for x in gen]
+
+
+def test_call_openai_yields_text_deltas(monkeypatch):
+    use_openai(monkeypatch, body=sse(
+        {"type": "response.created"}, delta("При"), delta("вет."), {"type": "response.completed"}
+    ))
+    assert asyncio.run(collect(main.call_openai("sys", "user"))) == ["При", "вет."]
+
+
+def test_call_openai_raises_on_failed_event(monkeypatch):
+    use_openai(monkeypatch, body=sse(delta("При"), {"type": "response.failed"}))
+    with pytest.raises(RuntimeError):
+        asyncio.run(collect(main.call_openai("sys", "user")))
+
+
+def test_answer_replaces_placeholder(monkeypatch, telegram):
+    use_openai(monkeypatch, body=sse(delta("Ответ."), delta("\n")))
+    assert asyncio.run(main.send_openai_answer(1, "sys", "user")) is True
+    # одна финальная правка, без повторной с тем же видимым текстом
+    assert telegram == [("send", None, "…"), ("edit", 1, "Ответ.")]
+
+
+def test_http_error_replaces_placeholder_with_error(monkeypatch, telegram):
+    use_openai(monkeypatch, status=500)
+    assert asyncio.run(main.send_openai_answer(1, "sys", "user")) is False
+    assert telegram[-1][0] == "edit"
+    assert telegram[-1][2].startswith("Не получилось получить ответ")
+
+
+def test_missing_placeholder_sends_answer(monkeypatch, telegram):
+    telegram.message_id = None
+    use_openai(monkeypatch, body=sse(delta("Ответ.")))
+    asyncio.run(main.send_openai_answer(1, "sys", "user"))
+    assert telegram == [("send", None, "…"), ("send", None, "Ответ.")]
+
+
+def test_telegram_pool_timeout_is_not_reported_as_openai(monkeypatch, telegram):
+    use_openai(monkeypatch, body=sse(delta("Раз.")))
+    monkeypatch.setattr(main, "TG_EDIT_INTERVAL", 0)
+
+    async def exhausted_edit(chat_id, mid, text):
+        exc = httpx.PoolTimeout("pool exhausted")
+        exc.request = httpx.Request("POST", main.TG_API + "/editMessageText")
+        raise exc
+
+    monkeypatch.setattr(main, "tg_edit_message", exhausted_edit)
+    with pytest.raises(httpx.PoolTimeout):
+        asyncio.run(main.send_openai_answer(1, "sys", "user"))
+    assert telegram == [("send", None, "…")]
+
+
+def test_whitespace_only_delta_does_not_edit(monkeypatch, telegram):
+    monkeypatch.setattr(main, "TG_EDIT_INTERVAL", 0)
+    use_openai(monkeypatch, body=sse(delta("Раз."), delta("\n"), delta("\n"), delta("Два.")))
+    asyncio.run(main.send_openai_answer(1, "sys", "user"))
+    assert telegram == [("send", None, "…"), ("edit", 1, "Раз."), ("edit", 1, "Раз.\n\nДва.")]
@@ -0,0 +1,121 @@
+import asyncio
+from collections import OrderedDict
+
+import httpx
+
+import main
+
+
+def use_telegram(monkeypatch, responses):
+    """Отдаёт ответы Bot API по очереди и возвращает список запрошенных путей."""
+    requests = []
+    responses = list(responses)
+
+    def handler(request):
+        requests.append(request.url.path)
+        return responses.pop(0)
+
+    client = httpx.AsyncClient(base_url=main.TG_API, transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(main, "tg_client", client)
+    monkeypatch.setattr(main, "_tg_per_chat", OrderedDict())
+    return requests
+
+
+def too_many_requests():
+    return httpx.Response(429, json={"ok": False, "parameters": {"retry_after": 0}})
+
+
+def test_send_returns_message_id(monkeypatch):
+    use_telegram(monkeypatch, [httpx.Response(200, json={"ok": True, "result": {"message_id": 7}})])
+    assert asyncio.run(main.tg_send_message(1, "hi")) == 7
+
+
+def test_retries_once_after_429(monkeypatch):
+    requests = use_telegram(monkeypatch, [
+        too_many_requests(),
+        httpx.Response(200, json={"ok": True, "result": {"message_id": 7}}),
+    ])
+    assert asyncio.run(main.tg_send_message(1, "hi")) == 7
+    assert len(requests) == 2
+
+
+def test_gives_up_after_second_429(monkeypatch):
+    requests = use_telegram(monkeypatch, [too_many_requests(), too_many_requests()])
+    assert asyncio.run(main.tg_send_message(1, "hi")) is None
+    assert len(requests) == 2
+
+
+def test_non_json_reply_does_not_raise(monkeypatch):
+    use_telegram(monkeypatch, [httpx.Response(502, text="<html>Bad Gateway</html>",
+                                              headers={"content-type": "text/html"})])
+    assert asyncio.run(main.tg_send_message(1, "hi")) is None
+
+
+def test_chat_limiters_are_bounded(monkeypatch):
+    monkeypatch.setattr(main, "_tg_per_chat", OrderedDict())
+    monkeypatch.setattr(main, "TG_CHAT_LIMITERS_MAX", 3)
+    for chat_id in range(5):
+        main._chat_limiter(chat_id)
+    assert list(main._tg_per_chat) == [2, 3, 4]
+
+
+def set_webhook_ok():
+    return httpx.Response(200, json={"ok": True, "result": True})
+
+
+def use_stamp(monkeypatch, path, force=False):
+    monkeypatch.setattr(main, "PUBLIC_URL", "https://bot.example.com")
+    monkeypatch.setattr(main, "WEBHOOK_STAMP_FILE", str(path))
+    monkeypatch.setattr(main, "FORCE_SET_WEBHOOK", force)
+
+
+def test_set_webhook_writes_stamp_and_skips_next_time(monkeypatch, tmp_path):
+    stamp = tmp_path / "stamp"
+    use_stamp(monkeypatch, stamp)
+    requests = use_telegram(monkeypatch, [set_webhook_ok()])
+    asyncio.run(main.set_webhook())
+    assert requests == [f"/bot{main.BOT_TOKEN}/setWebhook"]
+    assert stamp.read_text()
+
+    requests = use_telegram(monkeypatch, [])
+    asyncio.run(main.set_webhook())
+    assert requests == []
+
+
+def test_set_webhook_changed_url_registers_again(monkeypatch, tmp_path):
+    stamp = tmp_path / "stamp"
+    stamp.write_text("stale")
+    use_stamp(monkeypatch, stamp)
+    requests = use_telegram(monkeypatch, [set_webhook_ok()])
+    asyncio.run(main.set_webhook())
+    assert len(requests) == 1
+    assert stamp.read_text() != "stale"
+
+
+def test_force_set_webhook_ignores_stamp(monkeypatch, tmp_path):
+    stamp = tmp_path / "stamp"
+    use_stamp(monkeypatch, stamp)
+    use_telegram(monkeypatch, [set_webhook_ok()])
+    asyncio.run(main.set_webhook())
+
+    monkeypatch.setattr(main, "FORCE_SET_WEBHOOK", True)
+    requests = use_telegram(monkeypatch, [set_webhook_ok()])
+    asyncio.run(main.set_webhook())
+    assert len(requests) == 1
+
+
+def test_failed_set_webhook_does_not_write_stamp(monkeypatch, tmp_path):
+    stamp = tmp_path / "stamp"
+    use_stamp(monkeypatch, stamp)
+    use_telegram(monkeypatch, [httpx.Response(401, json={"ok": False, "description": "Unauthorized"})])
+    asyncio.run(main.set_webhook())
+    assert not stamp.exists()
+
+
+def test_unreadable_and_unwritable_stamp_are_ignored(monkeypatch, tmp_path):
+    # каталог вместо файла — не читается; путь в несуществующем каталоге — не пишется
+    for path in (tmp_path, tmp_path / "missing" / "stamp"):
+        use_stamp(monkeypatch, path)
+        requests = use_telegram(monkeypatch, [set_webhook_ok()])
+        asyncio.run(main.set_webhook())
+        assert len(requests) == 1
@@ -0,0 +1,228 @@
+import asyncio
+
+import httpx
+import orjson
+import pytest
+
+import main
+from conftest import message
+
+
+def test_date_time_city_flow(bot, sent):
+    bot(message("/start"))
+    assert main.SESSIONS[1]["state"] == "ASK_DATE"
+
+    bot(message("14.08.1992"))
+    assert main.SESSIONS[1]["state"] == "ASK_TIME"
+    assert main.SESSIONS[1]["data"]["date"] == "1992-08-14"
+
+    bot(message("07:30"))
+    assert main.SESSIONS[1]["state"] == "ASK_CITY"
+    assert main.SESSIONS[1]["data"]["time"] == "07:30"
+
+    bot(message("Barcelona / Spain"))
+    sess = main.SESSIONS[1]
+    assert sess["state"] == "ASK_TZ"
+    assert (sess["data"]["city"], sess["data"]["country"]) == ("Barcelona", "Spain")
+    assert sent[-1].startswith("Ок. Теперь часовой пояс")
+
+
+def test_city_without_country_asks_for_country(bot, sent):
+    bot(message("/start"))
+    bot(message("1992-08-14"))
+    bot(message("07:30"))
+    bot(message("Barcelona"))
+    assert main.SESSIONS[1]["state"] == "ASK_COUNTRY"
+    assert main.SESSIONS[1]["data"]["city"] == "Barcelona"
+
+
+def test_invalid_date_keeps_state(bot, sent):
+    bot(message("/start"))
+    bot(message("14/08/1992"))
+    assert main.SESSIONS[1]["state"] == "ASK_DATE"
+    assert sent[-1].startswith("Не поняла дату")
+
+
+def test_handlers_cover_input_states():
+    assert set(main._HANDLERS) == {"ASK_DATE", "ASK_TIME", "ASK_CITY", "ASK_COUNTRY", "ASK_TZ", "ASK_FREEFORM"}
+
+
+def test_dispatch_calls_handler_for_state(bot, sent, monkeypatch):
+    calls = []
+
+    async def fake_handler(sess, d, text, chat_id):
+        calls.append((sess["state"], text, chat_id))
+
+    monkeypatch.setitem(main._HANDLERS, "ASK_DATE", fake_handler)
+    bot(message("/start"))
+    bot(message("hello", chat_id=1))
+    assert calls == [("ASK_DATE", "hello", 1)]
+    assert len(sent) == 1  # только приветствие, fallback не сработал
+
+
+def test_state_without_handler_falls_back(bot, sent):
+    main.SESSIONS[1] = main.new_session()
+    main.SESSIONS[1]["state"] = "ASK_TOPIC"
+    bot(message("что-то"))
+    assert sent[-1].startswith("Я чуть потерялась")
+
+
+def callback(data, chat_id=1):
+    return {"update_id": 2, "callback_query": {"id": "cq", "data": data, "message": {"chat": {"id": chat_id}}}}
+
+
+def test_topic_button_without_session_restarts_onboarding(bot, sent):
+    bot(callback("topic:career"))
+    assert main.SESSIONS[1]["state"] == "ASK_DATE"
+    assert sent[-1].startswith("Давай начнём")
+
+
+def test_topic_button_with_birth_data_asks_question(bot, sent):
+    sess = main.new_session()
+    sess["state"] = "ASK_TOPIC"
+    sess["data"].update(date="1992-08-14", time="07:30", tz="Europe/Madrid")
+    main.SESSIONS[1] = sess
+    bot(callback("topic:career"))
+    assert main.SESSIONS[1]["state"] == "ASK_FREEFORM"
+    assert main.SESSIONS[1]["data"]["topic"] == "career"
+
+
+def test_handler_error_is_reported_to_user(bot, sent, monkeypatch):
+    async def broken_handler(sess, d, text, chat_id):
+        raise ValueError("boom")
+
+    monkeypatch.setitem(main._HANDLERS, "ASK_DATE", broken_handler)
+    bot(message("/start"))
+    bot(message("1992-08-14"))
+    assert sent[-1].startswith("Что-то пошло не так")
+    assert main._CHAT_LOCKS == {}
+
+
+def freeform_session():
+    sess = main.new_session()
+    sess["state"] = "ASK_FREEFORM"
+    sess["data"].update(date="1992-08-14", time="07:30", city="Barcelona", country="Spain",
+                        tz="Europe/Madrid", topic="career")
+    return sess
+
+
+def pool_timeout(host):
+    exc = httpx.PoolTimeout("pool exhausted")
+    exc.request = httpx.Request("GET", f"https://{host}/")
+    return exc
+
+
+def test_geocode_pool_timeout_reports_busy(bot, sent, monkeypatch):
+    async def exhausted(city, country):
+        raise pool_timeout("nominatim.openstreetmap.org")
+
+    monkeypatch.setattr(main, "OPENAI_API_KEY", "test")
+    monkeypatch.setattr(main, "geocode_city", exhausted)
+    main.SESSIONS[1] = freeform_session()
+    bot(message("куда расти в карьере?"))
+    assert sent[-1] == main.BUSY_TEXT
+    assert main.SESSIONS[1]["state"] == "ASK_FREEFORM"
+
+
+def test_telegram_pool_timeout_does_not_reply(bot, sent, monkeypatch):
+    async def exhausted(sess, d, text, chat_id):
+        raise pool_timeout("api.telegram.org")
+
+    monkeypatch.setitem(main._HANDLERS, "ASK_DATE", exhausted)
+    bot(message("/start"))
+    bot(message("1992-08-14"))
+    assert len(sent) == 1  # только приветствие
+
+
+def test_callback_is_answered_while_chat_is_busy(sent, monkeypatch):
+    answered = []
+
+    async def fake_answer_callback(callback_query_id):
+        answered.append(callback_query_id)
+
+    monkeypatch.setattr(main, "tg_answer_callback", fake_answer_callback)
+
+    async def run():
+        lock = asyncio.Lock()
+        await lock.acquire()  # в чате идёт другая обработка
+        main._CHAT_LOCKS[1] = [lock, 1]
+        task = asyncio.create_task(main._process_update(callback("topic:career")))
+        await asyncio.sleep(0.05)
+        assert answered == ["cq"]
+        assert not task.done()
+        lock.release()
+        await task
+        del main._CHAT_LOCKS[1]
+
+    asyncio.run(run())
+
+
+def test_fire_logs_failed_task(caplog):
+    async def failing():
+        raise ValueError("boom")
+
+    async def run():
+        task = main.fire(failing())
+        await asyncio.wait({task})
+        await asyncio.sleep(0)  # done-колбэки вызываются следующей итерацией цикла
+
+    asyncio.run(run())
+    assert not main._BG_TASKS
+    assert any(r.message == "Background task failed" and r.exc_info[0] is ValueError for r in caplog.records)
+
+
+@pytest.fixture
+def freeform(sent, monkeypatch):
+    """Сессии хранятся сериализованными (как в Redis), геокодинг и OpenAI подменены."""
+    store = {}
+    geocoded = []
+    answers = ["Ответ."]
+
+    async def fake_get_session(chat_id):
+        return orjson.loads(store[chat_id]) if chat_id in store else None
+
+    async def fake_save_session(chat_id, sess):
+        store[chat_id] = orjson.dumps(sess)
+
+    async def fake_geocode(city, country):
+        geocoded.append((city, country))
+        return 41.39, 2.17
+
+    async def fake_openai(system_prompt, user_text):
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        yield answer
+
+    async def fake_edit(chat_id, message_id, text):
+        sent.append(text)
+
+    monkeypatch.setattr(main, "OPENAI_API_KEY", "test")
+    monkeypatch.setattr(main, "get_session", fake_get_session)
+    monkeypatch.setattr(main, "save_session", fake_save_session)
+    monkeypatch.setattr(main, "geocode_city", fake_geocode)
+    monkeypatch.setattr(main, "call_openai", fake_openai)
+    monkeypatch.setattr(main, "tg_edit_message", fake_edit)
+    store[1] = orjson.dumps(freeform_session())
+    return geocoded, answers
+
+
+def test_second_topic_reuses_session_chart(bot, freeform):
+    geocoded, answers = freeform
+    answers.append("Второй ответ.")
+    bot(message("куда расти в карьере?"))
+    bot(callback("topic:money"))
+    bot(message("а что с деньгами?"))
+    assert geocoded == [("Barcelona", "Spain")]
+    assert not answers
+
+
+def test_chart_is_saved_when_generation_fails(bot, sent, freeform):
+    geocoded, answers = freeform
+    answers[:] = [RuntimeError("stream failed"), "Ответ."]
+    bot(message("куда расти в карьере?"))
+    assert sent[-1].startswith("Не получилось получить ответ")
+    bot(message("куда расти в карьере?"))
+    assert geocoded == [("Barcelona", "Spain")]
+    assert sent.count("⏳ считаю карту…") == 1
+    assert sent[-2] == "Ответ."